@@ -1,5 +1,3 @@
-import base64
-import json
 import os
 import sqlite3
 import tempfile
@@ -7,17 +5,72 @@ from io import BytesIO
 
 import cv2
 import numpy as np
+import orjson
 import pandas as pd
+import pybase64
 import pydicom
 import requests
 import streamlit as st
-from PIL import Image
+from numba import njit, prange
+from PIL import Image, ImageSequence
+from requests.adapters import HTTPAdapter
+
+# DICOM uploads up to this size are parsed straight from memory; larger
+# studies spool to a tempfile to bound memory
+DICOM_INMEMORY_LIMIT = 1 * 1024 * 1024
+
+# Most frames shipped to Ollama in one "Analyze all frames" request;
+# keeps the images list inside the model context
+VOLUME_MAX_FRAMES = 8
+
+# Keep-alive connections to Ollama; avoids a fresh TCP handshake on
+# every analyze call
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+# PROMPTS = {
+#     "General_Description": "Provide a detailed description of this MRI image, including the visible anatomical structures and any notable features.",
+#     "Anomaly_Detection": "Analyze this MRI image and identify any potential anomalies or unusual patterns. Focus on areas that appear different from normal tissue.",
+#     "Segmentation": "Identify and describe the different segments and regions visible in this MRI image, including tissue types and anatomical structures.",
+#     "Condition_Identification": "Based on this MRI image, identify any potential medical conditions or pathologies that might be present. List any concerning features.",
+#     "Volume_Summary": "These images are consecutive slices of an MRI volume. Summarize the purpose of analyzing the whole volume, analyze how the findings change across slices, and conclude with a short summary of the volume-level findings.",
+# }
+PROMPTS = {
+    "General_Description": "هدف از تحلیل این تصویر MRI را به‌طور خلاصه بیان کنید، ویژگی‌های کلیدی آن را به‌اختصار شرح دهید، محتوای تصویر را تجزیه‌وتحلیل کنید و در پایان، خلاصه‌ای از یافته‌ها ارائه دهید.",
+    "Anomaly_Detection": "هدف از شناسایی ناهنجاری‌ها در این تصویر MRI را به‌طور خلاصه توضیح دهید، ناهنجاری‌های احتمالی را تجزیه‌وتحلیل کنید و در نهایت، خلاصه‌ای مختصر از ناهنجاری‌های شناسایی‌شده ارائه نمایید.",
+    "Segmentation": "فرآیند بخش‌بندی در این تصویر MRI را به‌طور خلاصه توضیح دهید، بخش‌های مختلف تصویر را مورد تجزیه‌وتحلیل قرار دهید و در پایان، خلاصه‌ای از نواحی بخش‌بندی‌شده ارائه دهید.",
+    "Condition_Identification": "هدف از شناسایی وضعیت‌های پزشکی در این تصویر MRI را به‌طور خلاصه بیان کنید، شرایط احتمالی موجود را تجزیه‌وتحلیل کنید و در نهایت، خلاصه‌ای از یافته‌های شناسایی‌شده ارائه دهید.",
+    "Volume_Summary": "این تصاویر برش‌های متوالی از یک حجم MRI هستند. هدف از تحلیل کل حجم را به‌طور خلاصه بیان کنید، تغییرات یافته‌ها در میان برش‌ها را تجزیه‌وتحلیل کنید و در پایان، خلاصه‌ای از یافته‌های کل حجم ارائه دهید.",
+}
+
+# The model/prompt/stream portion of the request body never changes, so
+# serialize it once per prompt at import; per request the body is then
+# just a concatenation of the prebuilt head and the base64 blobs
+PAYLOAD_TAIL = b'"]}'
+PAYLOAD_HEAD = {
+    name: orjson.dumps({"model": "llama3.2-vision", "prompt": prompt, "stream": True})[
+        :-1
+    ]
+    + b',"images":["'
+    for name, prompt in PROMPTS.items()
+}
+
+
+def build_payload(analysis_type, images_base64):
+    return (
+        PAYLOAD_HEAD[analysis_type]
+        + b'","'.join(img.encode() for img in images_base64)
+        + PAYLOAD_TAIL
+    )
 
 
 # Database setup
 def init_db():
     conn = sqlite3.connect("mri_analysis.db")
     c = conn.cursor()
+    # WAL + synchronous=NORMAL so each commit doesn't force a full fsync
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
     c.execute(
         """
         CREATE TABLE IF NOT EXISTS analysis_history
@@ -28,29 +81,32 @@ def init_db():
          timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
     """
     )
+    # Serves the history dashboard's ORDER BY timestamp DESC LIMIT with
+    # an index probe instead of a scan + sort
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ts ON analysis_history(timestamp DESC)")
     conn.commit()
     conn.close()
 
 
 # Modified Ollama API interaction
-def analyze_image_with_ollama(image_base64, prompt):
+def analyze_image_with_ollama(images_base64, analysis_type):
     api_url = "http://localhost:11434/api/generate"
-    payload = {
-        "model": "llama3.2-vision",
-        "prompt": prompt,
-        "images": [image_base64],
-        "stream": True,  # Set to False to get complete response
-    }
+    body = build_payload(analysis_type, images_base64)
 
     try:
-        response = requests.post(api_url, json=payload)
+        response = SESSION.post(
+            api_url,
+            data=body,
+            headers={"Content-Type": "application/json"},
+            stream=True,
+        )
         response.raise_for_status()  # Raise an exception for bad status codes
 
         # Handle streaming response
         # analysis_result = ""
-        for line in response.iter_lines():
+        for line in response.iter_lines(chunk_size=64 * 1024, decode_unicode=False):
             if line:
-                json_response = json.loads(line)
+                json_response = orjson.loads(line)
                 if "response" in json_response:
                     # analysis_result += json_response["response"]
                     yield json_response["response"]  # ارسال داده به‌صورت استریم
@@ -59,41 +115,81 @@ def analyze_image_with_ollama(image_base64, prompt):
                     break
     except requests.exceptions.RequestException as e:
         yield f"API Request Error: {str(e)}"
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         yield f"JSON Decode Error: {str(e)}"
     except Exception as e:
         yield f"Unexpected Error: {str(e)}"
 
 
 # Image processing functions
+def encode_png_b64(image_data):
+    # Level-1 PNG via OpenCV: far less zlib work than Pillow's default
+    # level 6, and Ollama doesn't care about the intermediate's size.
+    # PIL arrays are RGB(A) while imencode expects BGR(A), so swap the
+    # color channels first.
+    if image_data.ndim == 3 and image_data.shape[2] == 3:
+        image_data = cv2.cvtColor(image_data, cv2.COLOR_RGB2BGR)
+    elif image_data.ndim == 3 and image_data.shape[2] == 4:
+        image_data = cv2.cvtColor(image_data, cv2.COLOR_RGBA2BGRA)
+    ok, buf = cv2.imencode(".png", image_data, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    return pybase64.b64encode(buf.tobytes()).decode("utf-8")
+
+
+# Fused min/max + scale-to-uint8 in one streaming pass per frame,
+# parallelized across frames; avoids the separate reduction and scale
+# passes (and the float32 temporary) of the NumPy version.
+@njit(parallel=True, fastmath=True, cache=True)
+def normalize_frames(image):
+    out = np.empty(image.shape, np.uint8)
+    for k in prange(image.shape[0]):
+        frame = image[k]
+        mn = frame.min()
+        mx = frame.max()
+        scale = 255.0 / max(float(mx - mn), 1.0)
+        for i in range(frame.shape[0]):
+            for j in range(frame.shape[1]):
+                out[k, i, j] = np.uint8((frame[i, j] - mn) * scale)
+    return out
+
+
+# Warm the parallel runtime once at import instead of on the first
+# multi-frame upload; also keeps the JIT compile out of the first
+# analysis a user runs
+normalize_frames(np.zeros((1, 1, 1), np.uint16))
+
+
 def process_dicom(dicom_file):
-    ds = pydicom.dcmread(dicom_file)
+    # defer_size skips eagerly loading large non-pixel elements (private
+    # tags, overlays); pixel data still decodes on demand via pixel_array
+    ds = pydicom.dcmread(dicom_file, defer_size="1 KB")
     if hasattr(ds, "PixelData"):
         image = ds.pixel_array
         if len(image.shape) == 2:
             return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
         else:
-            return [
-                cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-                for frame in image
-            ]
+            return normalize_frames(image)
     return None
 
 
-def save_analysis_result(filename, analysis_type, results):
+def save_many(rows):
+    # One transaction (one disk sync) for the whole batch, with a single
+    # prepared statement reused across rows.
     conn = sqlite3.connect("mri_analysis.db")
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO analysis_history (filename, analysis_type, results)
-        VALUES (?, ?, ?)
-    """,
-        (filename, analysis_type, json.dumps(results)),
-    )
-    conn.commit()
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO analysis_history (filename, analysis_type, results)
+            VALUES (?, ?, ?)
+        """,
+            rows,
+        )
     conn.close()
 
 
+def save_analysis_result(filename, analysis_type, results):
+    save_many([(filename, analysis_type, orjson.dumps(results).decode())])
+
+
 def main():
     st.title("MRI Image Analysis System")
     init_db()
@@ -121,26 +217,36 @@ def main():
 
         # Process the uploaded file
         if file_extension == "dcm":
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                image_data = process_dicom(tmp_file.name)
-            os.unlink(tmp_file.name)
+            raw = uploaded_file.getvalue()
+            if len(raw) <= DICOM_INMEMORY_LIMIT:
+                image_data = process_dicom(BytesIO(raw))
+            else:
+                with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+                    tmp_file.write(raw)
+                    image_data = process_dicom(tmp_file.name)
+                os.unlink(tmp_file.name)
         else:
             image = Image.open(uploaded_file)
             if file_extension == "gif":
-                frames = []
-                try:
-                    while True:
-                        frames.append(np.array(image.copy()))
-                        image.seek(len(frames))
-                except EOFError:
-                    pass
+                # One contiguous (N, H, W, 3) buffer instead of a list of
+                # per-frame copies; better cache behavior for the slider.
+                # Convert every frame to one fixed mode: Pillow yields
+                # palette GIF frames as P, RGB or RGBA depending on the
+                # frame, which would otherwise vary the array shape.
+                n_frames = getattr(image, "n_frames", 1)
+                first = np.asarray(image.convert("RGB"))
+                frames = np.empty((n_frames,) + first.shape, np.uint8)
+                for i, frame in enumerate(ImageSequence.Iterator(image)):
+                    frames[i] = np.asarray(frame.convert("RGB"))
                 image_data = frames
             else:
                 image_data = np.array(image)
 
         # Display the image(s)
-        if isinstance(image_data, list):
+        is_frame_stack = file_extension == "gif" or (
+            file_extension == "dcm" and image_data.ndim == 3
+        )
+        if is_frame_stack:
             # Handle multi-frame images
             frame_idx = st.slider("Select frame", 0, len(image_data) - 1, 0)
             st.image(image_data[frame_idx], caption=f"Frame {frame_idx+1}")
@@ -150,32 +256,14 @@ def main():
             current_frame = image_data
 
         # Prepare image for Ollama
-        img_bytes = BytesIO()
-        Image.fromarray(current_frame).save(img_bytes, format="PNG")
-        img_base64 = base64.b64encode(img_bytes.getvalue()).decode("utf-8")
-
-        # Analysis prompts based on type
-        # prompts = {
-        #     "General_Description": "Provide a detailed description of this MRI image, including the visible anatomical structures and any notable features.",
-        #     "Anomaly_Detection": "Analyze this MRI image and identify any potential anomalies or unusual patterns. Focus on areas that appear different from normal tissue.",
-        #     "Segmentation": "Identify and describe the different segments and regions visible in this MRI image, including tissue types and anatomical structures.",
-        #     "Condition_Identification": "Based on this MRI image, identify any potential medical conditions or pathologies that might be present. List any concerning features.",
-        # }
-        prompts = {
-            "General_Description": "هدف از تحلیل این تصویر MRI را به‌طور خلاصه بیان کنید، ویژگی‌های کلیدی آن را به‌اختصار شرح دهید، محتوای تصویر را تجزیه‌وتحلیل کنید و در پایان، خلاصه‌ای از یافته‌ها ارائه دهید.",
-            "Anomaly_Detection": "هدف از شناسایی ناهنجاری‌ها در این تصویر MRI را به‌طور خلاصه توضیح دهید، ناهنجاری‌های احتمالی را تجزیه‌وتحلیل کنید و در نهایت، خلاصه‌ای مختصر از ناهنجاری‌های شناسایی‌شده ارائه نمایید.",
-            "Segmentation": "فرآیند بخش‌بندی در این تصویر MRI را به‌طور خلاصه توضیح دهید، بخش‌های مختلف تصویر را مورد تجزیه‌وتحلیل قرار دهید و در پایان، خلاصه‌ای از نواحی بخش‌بندی‌شده ارائه دهید.",
-            "Condition_Identification": "هدف از شناسایی وضعیت‌های پزشکی در این تصویر MRI را به‌طور خلاصه بیان کنید، شرایط احتمالی موجود را تجزیه‌وتحلیل کنید و در نهایت، خلاصه‌ای از یافته‌های شناسایی‌شده ارائه دهید.",
-        }
+        img_base64 = encode_png_b64(current_frame)
 
-        if st.button("Analyze Image"):
+        def run_analysis(images_b64, prompt_name):
             with st.spinner("Analyzing image..."):
                 result_placeholder = st.empty()  # Create a placeholder for live updates
                 full_response = ""
 
-                for chunk in analyze_image_with_ollama(
-                    img_base64, prompts[analysis_type]
-                ):
+                for chunk in analyze_image_with_ollama(images_b64, prompt_name):
                     if chunk:
                         full_response += chunk
                         # Apply RTL styling to the live output
@@ -190,11 +278,26 @@ def main():
 
                 st.success("Analysis Complete!")
 
+        if st.button("Analyze Image"):
+            run_analysis([img_base64], analysis_type)
+
+        if is_frame_stack and st.button("Analyze all frames"):
+            # One Ollama request for the whole stack: HTTP round-trip and
+            # model-context setup are paid once instead of per frame
+            stride = -(-len(image_data) // VOLUME_MAX_FRAMES)
+            run_analysis(
+                [encode_png_b64(frame) for frame in image_data[::stride]],
+                "Volume_Summary",
+            )
+
         # Show history
         st.subheader("Analysis History")
         conn = sqlite3.connect("mri_analysis.db")
-        history = pd.read_sql_query(
-            "SELECT * FROM analysis_history ORDER BY timestamp DESC LIMIT 5", conn
+        # Leave the results JSON blob out of the dashboard query
+        history = pd.read_sql(
+            "SELECT filename, analysis_type, timestamp FROM analysis_history "
+            "ORDER BY timestamp DESC LIMIT 5",
+            conn,
         )
         conn.close()
         st.dataframe(history)